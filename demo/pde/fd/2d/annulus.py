@@ -68,26 +68,39 @@ interior, = (smpid==-1).nonzero()
 bnd_vert = np.array([[0.0,0.0],[10*np.cos(gap/2.0),10*np.sin(gap/2.0)]])
 bnd_smp = np.array([[0,1]])
 weight_kwargs = {'vert':bnd_vert,'smp':bnd_smp,'n':20}
-# build lhs
+# build lhs. The matrices for each node group are built in COO format 
+# so that their entries can be assembled into one CSR matrix
 # enforce laplacian on interior nodes
 A_interior = weight_matrix(nodes[interior],nodes,[[2,0],[0,2]],
-                           **weight_kwargs)
+                           coo=True,**weight_kwargs)
 
 # find boundary normal vectors
 normals = simplex_outward_normals(vert,smp)[smpid[boundary]]
-n1 = scipy.sparse.diags(normals[:,0],0)
-n2 = scipy.sparse.diags(normals[:,1],0)
-# enforce free surface boundary conditions
-A_boundary = (n1*weight_matrix(nodes[boundary],nodes,[1,0],**weight_kwargs) +
-              n2*weight_matrix(nodes[boundary],nodes,[0,1],**weight_kwargs))
+# enforce free surface boundary conditions. The rows of each 
+# differentiation matrix are scaled in place by a component of the 
+# normal vectors. The two matrices are summed when their duplicate 
+# entries are added together in the conversion to CSR below
+A_x = weight_matrix(nodes[boundary],nodes,[1,0],coo=True,**weight_kwargs)
+A_x.data *= normals[A_x.row,0]
+A_y = weight_matrix(nodes[boundary],nodes,[0,1],coo=True,**weight_kwargs)
+A_y.data *= normals[A_y.row,1]
 
 # These next two matrices are really just identity matrices padded with zeros
-A_slit_top = weight_matrix(nodes[slit_top],nodes,[0,0],**weight_kwargs)
-A_slit_bot = weight_matrix(nodes[slit_bot],nodes,[0,0],**weight_kwargs)
+A_slit_top = weight_matrix(nodes[slit_top],nodes,[0,0],coo=True,
+                           **weight_kwargs)
+A_slit_bot = weight_matrix(nodes[slit_bot],nodes,[0,0],coo=True,
+                           **weight_kwargs)
 
-# stack all the matrices
-A = scipy.sparse.vstack((A_interior,A_boundary,
-                         A_slit_top,A_slit_bot))
+# assemble all the matrices with a single conversion to CSR. The rows 
+# of each matrix are offset by the number of rows above it
+offsets = np.cumsum([0,interior.shape[0],boundary.shape[0],
+                     slit_top.shape[0],slit_bot.shape[0]])
+blocks = [(A_interior,offsets[0]),(A_x,offsets[1]),(A_y,offsets[1]),
+          (A_slit_top,offsets[2]),(A_slit_bot,offsets[3])]
+data = np.concatenate([b.data for b,o in blocks])
+rows = np.concatenate([b.row + o for b,o in blocks])
+cols = np.concatenate([b.col for b,o in blocks])
+A = scipy.sparse.csr_matrix((data,(rows,cols)),(offsets[-1],nodes.shape[0]))
 
 # build the rhs 
 d_interior = np.zeros(interior.shape[0])
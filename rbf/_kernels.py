@@ -0,0 +1,246 @@
+'''
+This module contains compiled kernels for evaluating some of the
+predefined RBFs and their low order derivatives. The kernels are
+compiled with numba, and *KERNELS* will be empty if numba cannot be
+imported.
+
+Each RBF is described by three scalar functions of *r* and *eps*. If
+the RBF is phi(r) then these functions are phi(r), g(r) = phi'(r)/r,
+and h(r) = (phi''(r) - phi'(r)/r)/r**2. The derivatives of the RBF
+with respect to the evaluation points are then
+
+  d(phi)/d(x_k) = (x_k - c_k)*g(r)
+
+  d^2(phi)/d(x_k)d(x_l) = delta_kl*g(r) + (x_k - c_k)*(x_l - c_l)*h(r)
+
+*stencil_kernel* returns kernels which evaluate an RBF for many 
+stencils at once. The stencil size is a compile-time constant in 
+these kernels.
+
+'''
+from __future__ import division
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+  import numba
+  HAS_NUMBA = True
+
+except ImportError:
+  HAS_NUMBA = False
+  logger.debug(
+    'Could not import numba. The predefined RBFs will be evaluated '
+    'with lambdified sympy expressions')
+
+
+# dictionary of kernels keyed by the name of the RBF
+KERNELS = {}
+
+# dictionary of the scalar functions (phi,g,h) keyed by the name of the 
+# RBF
+FUNCTIONS = {}
+
+# stencil kernels keyed by the name of the RBF and the stencil size
+_STENCIL_KERNELS = {}
+
+
+def _make_kernel(phi,g,h):
+  '''
+  Returns a kernel which evaluates an RBF, or one of its
+  first or second derivatives, for each pair of evaluation points
+  and centers. The kernel has the call signature
+  *kernel(x,c,eps,order,k,l,out)* where *order* is the total
+  derivative order and *k* and *l* are the differentiated axes. 
+  
+  The kernel is not multithreaded. It is typically evaluated for small 
+  stencils, where launching threads costs more than the evaluation, 
+  and numba's thread pools are not safe to use in the subprocesses 
+  spawned by *rbf.mp.parmap*.
+  '''
+  @numba.njit(fastmath=True)
+  def kernel(x,c,eps,order,k,l,out):
+    N,D = x.shape
+    M = c.shape[0]
+    for i in range(N):
+      for j in range(M):
+        r2 = 0.0
+        for d in range(D):
+          r2 += (x[i,d] - c[j,d])**2
+
+        r = np.sqrt(r2)
+        if order == 0:
+          out[i,j] = phi(r,eps[j])
+
+        elif order == 1:
+          out[i,j] = (x[i,k] - c[j,k])*g(r,eps[j])
+
+        else:
+          val = (x[i,k] - c[j,k])*(x[i,l] - c[j,l])*h(r,eps[j])
+          if k == l:
+            val += g(r,eps[j])
+
+          out[i,j] = val
+
+  return kernel
+
+
+def _make_stencil_kernel(phi,g,h,size):
+  ''' 
+  Returns a kernel which evaluates an RBF, or one of its first or 
+  second derivatives, for a batch of stencils with *size* nodes. The 
+  kernel has the call signature *kernel(x,c,eps,order,k,l,out)*, where 
+  *x* is a (K,P,D) array of evaluation points, *c* is a (K,size,D) 
+  array of stencil nodes, *eps* is a (K,size) array of shape 
+  parameters, and *out* is a (K,P,size) array. *size* is frozen into 
+  the kernel by numba, so the loop over the stencil nodes has a known 
+  trip count and can be unrolled and vectorized by the compiler.
+  '''
+  @numba.njit(fastmath=True)
+  def kernel(x,c,eps,order,k,l,out):
+    K,P,D = x.shape
+    for s in range(K):
+      for i in range(P):
+        for j in range(size):
+          r2 = 0.0
+          for d in range(D):
+            r2 += (x[s,i,d] - c[s,j,d])**2
+
+          r = np.sqrt(r2)
+          if order == 0:
+            out[s,i,j] = phi(r,eps[s,j])
+
+          elif order == 1:
+            out[s,i,j] = (x[s,i,k] - c[s,j,k])*g(r,eps[s,j])
+
+          else:
+            val = ((x[s,i,k] - c[s,j,k])*(x[s,i,l] - c[s,j,l])*
+                   h(r,eps[s,j]))
+            if k == l:
+              val += g(r,eps[s,j])
+
+            out[s,i,j] = val
+
+  return kernel
+
+
+def stencil_kernel(name,size):
+  ''' 
+  Returns the stencil kernel for the RBF named *name* and stencils 
+  with *size* nodes. The kernel is created the first time it is 
+  requested and then stored in *_STENCIL_KERNELS*. 
+  '''
+  key = (name,size)
+  if key not in _STENCIL_KERNELS:
+    _STENCIL_KERNELS[key] = _make_stencil_kernel(*FUNCTIONS[name],size=size)
+
+  return _STENCIL_KERNELS[key]
+
+
+if HAS_NUMBA:
+  _jit = numba.njit(fastmath=True)
+
+  # Gaussian
+  @_jit
+  def _ga_phi(r,eps):
+    return np.exp(-(eps*r)**2)
+
+  @_jit
+  def _ga_g(r,eps):
+    return -2*eps**2*np.exp(-(eps*r)**2)
+
+  @_jit
+  def _ga_h(r,eps):
+    return 4*eps**4*np.exp(-(eps*r)**2)
+
+  # inverse quadratic
+  @_jit
+  def _iq_phi(r,eps):
+    return 1/(1 + (eps*r)**2)
+
+  @_jit
+  def _iq_g(r,eps):
+    return -2*eps**2/(1 + (eps*r)**2)**2
+
+  @_jit
+  def _iq_h(r,eps):
+    return 8*eps**4/(1 + (eps*r)**2)**3
+
+  # inverse multiquadratic
+  @_jit
+  def _imq_phi(r,eps):
+    return 1/np.sqrt(1 + (eps*r)**2)
+
+  @_jit
+  def _imq_g(r,eps):
+    return -eps**2/(1 + (eps*r)**2)**1.5
+
+  @_jit
+  def _imq_h(r,eps):
+    return 3*eps**4/(1 + (eps*r)**2)**2.5
+
+  # multiquadratic
+  @_jit
+  def _mq_phi(r,eps):
+    return np.sqrt(1 + (eps*r)**2)
+
+  @_jit
+  def _mq_g(r,eps):
+    return eps**2/np.sqrt(1 + (eps*r)**2)
+
+  @_jit
+  def _mq_h(r,eps):
+    return -eps**4/(1 + (eps*r)**2)**1.5
+
+  # third-order polyharmonic spline. *h* is singular at the center but
+  # it is always multiplied by a factor which is zero there
+  @_jit
+  def _phs3_phi(r,eps):
+    return (eps*r)**3
+
+  @_jit
+  def _phs3_g(r,eps):
+    return 3*eps**3*r
+
+  @_jit
+  def _phs3_h(r,eps):
+    if r == 0.0:
+      return 0.0
+
+    return 3*eps**3/r
+
+  # fifth-order polyharmonic spline
+  @_jit
+  def _phs5_phi(r,eps):
+    return (eps*r)**5
+
+  @_jit
+  def _phs5_g(r,eps):
+    return 5*eps**5*r**3
+
+  @_jit
+  def _phs5_h(r,eps):
+    return 15*eps**5*r
+
+  # seventh-order polyharmonic spline
+  @_jit
+  def _phs7_phi(r,eps):
+    return (eps*r)**7
+
+  @_jit
+  def _phs7_g(r,eps):
+    return 7*eps**7*r**5
+
+  @_jit
+  def _phs7_h(r,eps):
+    return 35*eps**7*r**3
+
+  FUNCTIONS['ga'] = (_ga_phi,_ga_g,_ga_h)
+  FUNCTIONS['iq'] = (_iq_phi,_iq_g,_iq_h)
+  FUNCTIONS['imq'] = (_imq_phi,_imq_g,_imq_h)
+  FUNCTIONS['mq'] = (_mq_phi,_mq_g,_mq_h)
+  FUNCTIONS['phs3'] = (_phs3_phi,_phs3_g,_phs3_h)
+  FUNCTIONS['phs5'] = (_phs5_phi,_phs5_g,_phs5_h)
+  FUNCTIONS['phs7'] = (_phs7_phi,_phs7_g,_phs7_h)
+  for name,funcs in FUNCTIONS.items():
+    KERNELS[name] = _make_kernel(*funcs)
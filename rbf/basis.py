@@ -39,57 +39,135 @@ Wendland (d=3, k=2)                wen32         Yes (1, 2, and 3-D)  :math:`(1
 ''' 
 from __future__ import division 
 from rbf.poly import powers
+from rbf._kernels import KERNELS, stencil_kernel
 import sympy 
 from scipy.sparse import csc_matrix
 from scipy.spatial import cKDTree
-from sympy.utilities.autowrap import ufuncify
+from scipy.spatial.distance import cdist
+from sympy.utilities.autowrap import CythonCodeWrapper, F2PyCodeWrapper
+from sympy.utilities.codegen import C99CodeGen, FCodeGen
+from sympy.utilities.lambdify import implemented_function
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np 
+import threading
+import warnings
+import importlib.util
+import importlib.machinery
+import hashlib
+import tempfile
+import weakref
+import shutil
 import logging
+import glob
+import os
 logger = logging.getLogger(__name__)
 
+try:
+  import Cython
+  _DEFAULT_BACKEND = 'cython'
 
-class _CallbackDict(dict):
+except ImportError:
+  _DEFAULT_BACKEND = 'numpy'
+
+# If the environment variable *RBF_SKIP_CHECKS* is set to 1 then the 
+# shapes of the arguments to an *RBF* are not checked when it is 
+# called. This reduces overhead when an *RBF* is evaluated many times 
+# with small arrays
+_SKIP_CHECKS = os.environ.get('RBF_SKIP_CHECKS','0') == '1'
+
+# directory where compiled numerical functions are stored so that they 
+# can be reused in later python sessions
+_CACHE_DIR = os.path.join(os.path.expanduser('~'),'.cache','rbf','ufuncs')
+
+# version of the code generated by *_ufuncify*. This is incremented 
+# when the generated code changes so that modules in *_CACHE_DIR* which 
+# were compiled by an older version are not used
+_CODEGEN_VERSION = 2
+
+class _SharedDict(dict):
   ''' 
-  dictionary that calls a function after any method is called that
-  could change its content.
+  dictionary that can be weakly referenced
   '''
-  def __init__(self,value,callback):
-    ''' 
-    Parameters
-    ----------
-    value : dict
-    callback : function
-    '''
-    dict.__init__(self,value)
-    self.callback = callback
+  pass
+
+
+# caches of numerical functions which are shared by *RBF* instances 
+# that have the same expression, *tol*, and *backend*. The keys are 
+# made by *RBF._cache_key*. Each cache is a dictionary of numerical 
+# functions keyed by the derivative and the user-specified limit for 
+# that derivative. The caches are weakly referenced, so they are 
+# discarded when no RBF uses them
+_CACHES = weakref.WeakValueDictionary()
+
+# limits at the RBF centers which were estimated by *RBF*, keyed by 
+# the expression and *tol*. Each value is a dictionary of limits keyed 
+# by the derivative. These are reused by RBFs that differ in their 
+# *backend* or other limits, and they are also weakly referenced
+_ESTIMATED_LIMITS = weakref.WeakValueDictionary()
+
+
+def _shared(caches,key):
+  ''' 
+  Returns the *_SharedDict* in *caches* for *key*, and adds a new one 
+  if it does not exist
+  '''
+  out = caches.get(key)
+  if out is None:
+    out = _SharedDict()
+    caches[key] = out
+
+  return out
+
+# keys, from *_compile_key*, of the functions which failed to compile. 
+# These functions are not compiled again in this python session, but 
+# other functions are still compiled with the same backend
+_FAILED_COMPILES = set()
+
+# *_ufuncify* modifies global state (*sys.path* and the working 
+# directory), so functions are compiled in one thread at a time
+_COMPILE_LOCK = threading.Lock()
+
+
+class _LimitsDict(dict):
+  ''' 
+  dictionary that increments its *epoch* attribute after any method 
+  is called that could change its content. This is used to lazily 
+  determine whether the numerical functions for an RBF are stale.
+  '''
+  def __init__(self,*args,**kwargs):
+    dict.__init__(self,*args,**kwargs)
+    self.epoch = 0
   
   def __delitem__(self,key):  
     dict.__delitem__(self,key)
-    self.callback()
+    self.epoch += 1
 
   def __setitem__(self,key,value):  
     dict.__setitem__(self,key,value)
-    self.callback()
+    self.epoch += 1
     
   def pop(self,*args):
-    dict.pop(self,*args)
-    self.callback()
+    out = dict.pop(self,*args)
+    self.epoch += 1
+    return out
 
   def popitem(self):
-    dict.popitem(self)
-    self.callback()
+    out = dict.popitem(self)
+    self.epoch += 1
+    return out
 
   def clear(self):
     dict.clear(self)
-    self.callback()
+    self.epoch += 1
   
   def setdefault(self,*args):
-    dict.setdefault(self,*args)  
-    self.callback()
+    out = dict.setdefault(self,*args)  
+    self.epoch += 1
+    return out
 
   def update(self,*args,**kwargs):    
     dict.update(self,*args,**kwargs)
-    self.callback()
+    self.epoch += 1
   
 
 def _assert_shape(a,shape,label):
@@ -115,6 +193,403 @@ def _assert_shape(a,shape,label):
   return
   
 
+def _call_lambdified(func,args,shape):
+  ''' 
+  Evaluates *func*, which was created with *sympy.lambdify*, and 
+  returns a float array with the specified shape. The output of a 
+  lambdified function is a scalar when the expression is constant, and 
+  so it is broadcasted here to *shape*. Warnings about invalid values 
+  are suppressed because the branches of a *Piecewise* expression are 
+  evaluated for all arguments.
+  '''
+  with np.errstate(divide='ignore',invalid='ignore'):
+    out = func(*args)
+
+  if np.shape(out) != shape:
+    out = np.full(shape,out,dtype=float)
+
+  return out
+
+
+def _lambdified_evaluator(func):
+  ''' 
+  Returns a function with the call signature *f(x,c,eps)* which 
+  evaluates *func*. *func* is a lambdified function of each component 
+  of the evaluation points and centers, and the shape parameter.
+  '''
+  def evaluate(x,c,eps):
+    shape = (x.shape[0],c.shape[0])
+    # expand to allow for broadcasting
+    x = x.T[:,:,None] 
+    c = c.T[:,None,:]
+    args = (tuple(x)+tuple(c)+(eps,))
+    return _call_lambdified(func,args,shape)
+
+  return evaluate
+
+
+def _radial_evaluator(func):
+  ''' 
+  Returns a function with the call signature *f(x,c,eps)* which 
+  evaluates *func*. *func* is a lambdified function of *r* and *eps*. 
+  The distances between the evaluation points and centers are 
+  computed once with *cdist*, rather than passing each component of 
+  the points to *func*. *cdist* always returns double precision 
+  distances, and they are cast back to the precision of *x*. The 
+  distances can also be passed in with the *r* argument if they have 
+  already been computed.
+  '''
+  def evaluate(x,c,eps,r=None):
+    shape = (x.shape[0],c.shape[0])
+    if r is None:
+      r = cdist(x,c)
+
+    r = r.astype(x.dtype,copy=False)
+    return _call_lambdified(func,(r,eps),shape)
+
+  return evaluate
+
+
+def _compiled_evaluator(func):
+  ''' 
+  Returns a function with the call signature *f(x,c,eps)* which 
+  evaluates *func*. *func* was created with *_ufuncify* using the 
+  'cython' or 'f2py' backend, and it only accepts 1-D arrays that all 
+  have the same length. Each argument is broadcasted to (N,M) without 
+  copying, and then it is copied once when it is cast to double 
+  precision, which is the only precision supported by *func*.
+  '''
+  def evaluate(x,c,eps):
+    shape = (x.shape[0],c.shape[0])
+    args = ([np.broadcast_to(xi[:,None],shape).astype(float).ravel() for xi in x.T] + 
+            [np.broadcast_to(ci[None,:],shape).astype(float).ravel() for ci in c.T] + 
+            [np.broadcast_to(eps,shape).astype(float).ravel()])
+    out = func(*args).reshape(shape)
+    return out
+
+  return evaluate
+
+
+def _radial_compiled_evaluator(func):
+  ''' 
+  Returns a function with the call signature *f(x,c,eps)* which 
+  evaluates *func*. *func* was created with *_ufuncify* using the 
+  'cython' or 'f2py' backend, and it is a function of *r* and *eps*. 
+  The distances can also be passed in with the *r* argument if they 
+  have already been computed.
+  '''
+  def evaluate(x,c,eps,r=None):
+    shape = (x.shape[0],c.shape[0])
+    if r is None:
+      r = cdist(x,c)
+
+    r = r.ravel()
+    eps = np.broadcast_to(eps,shape).astype(float).ravel()
+    out = func(r,eps).reshape(shape)
+    return out
+
+  return evaluate
+
+
+def _load_module(path):
+  ''' 
+  Imports the extension module at *path*
+  '''
+  name = os.path.basename(path).split('.')[0]
+  spec = importlib.util.spec_from_file_location(name,path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def _compile_key(args,expr,backend):
+  ''' 
+  Returns the name of the subdirectory of *_CACHE_DIR* where the 
+  compiled extension module for *expr* is stored. This is a hash of 
+  *srepr* for *expr* and *args*, which, unlike *str*, distinguishes 
+  expressions that only differ in the precision of their floats or 
+  the assumptions on their symbols. The versions of sympy, numpy, and 
+  the generated code are also hashed since they determine the code and 
+  the numpy C API that the module is built against. The python version 
+  is accounted for by the extension suffix.
+  '''
+  key = repr((sympy.srepr(expr),tuple(sympy.srepr(a) for a in args),
+              backend,sympy.__version__,np.__version__,_CODEGEN_VERSION))
+  key = hashlib.sha1(key.encode()).hexdigest()
+  return key
+
+
+def _load_cached(path):
+  ''' 
+  Returns the compiled function stored in the directory *path*, or 
+  *None* if there is no usable module there. A directory without a 
+  module that can be imported is removed so that the function is 
+  compiled again.
+  '''
+  if not os.path.exists(path):
+    return None
+
+  for suffix in importlib.machinery.EXTENSION_SUFFIXES:
+    paths = glob.glob(os.path.join(path,'wrapper_module_*' + suffix))
+    if paths:
+      logger.debug('Loading compiled function from %s' % paths[0])
+      try:
+        module = _load_module(paths[0])
+
+      except Exception as err:
+        logger.warning(
+          'Failed to load the compiled function in %s. It will be '
+          'compiled again. The error was: %s' % (path,repr(err)))
+        break
+
+      # the function is named *autofunc_c* by the cython backend and 
+      # *autofunc* by the f2py backend
+      if hasattr(module,'autofunc_c'):
+        return module.autofunc_c
+
+      else:
+        return module.autofunc
+
+  shutil.rmtree(path,ignore_errors=True)
+  return None
+
+
+class _CSECodeGen(C99CodeGen):
+  ''' 
+  C code generator which eliminates common subexpressions in routines 
+  that do not contain indexed arrays. sympy does not support common 
+  subexpression elimination for indexed arrays, so it is done in a 
+  scalar helper routine which is called in the loop over the arrays.
+  '''
+  def routine(self,name,expr,argument_sequence=None,global_vars=None):
+    self.cse = not expr.has(sympy.Indexed)
+    return C99CodeGen.routine(self,name,expr,argument_sequence,global_vars)
+
+
+class _NamedModule(object):
+  ''' 
+  Mixin for the autowrap code wrappers which gives the extension module 
+  the name *module_name*, rather than a name derived from a counter 
+  that is shared by all code wrappers.
+  '''
+  def __init__(self,module_name,*args,**kwargs):
+    self._module_name = module_name
+    super(_NamedModule,self).__init__(*args,**kwargs)
+
+  @property
+  def module_name(self):
+    return self._module_name
+
+
+class _CythonCodeWrapper(_NamedModule,CythonCodeWrapper):
+  pass
+
+
+class _F2PyCodeWrapper(_NamedModule,F2PyCodeWrapper):
+  pass
+
+
+def _ufuncify(args,expr,backend,tempdir,module_name):
+  ''' 
+  Compiles *expr* in *tempdir* with the specified backend into the 
+  extension module *module_name*. This is 
+  like *ufuncify*, except that the 'cython' backend evaluates *expr* 
+  with a scalar helper routine in which common subexpressions are only 
+  evaluated once. The derivatives of an RBF share many subexpressions 
+  (e.g., *r* and the exponentials), and the C compiler does not merge 
+  calls to *exp* or *sqrt*. sympy cannot eliminate common 
+  subexpressions in Fortran code, so *expr* is evaluated directly in 
+  the loop with the 'f2py' backend.
+
+  The returned function takes 1-D arrays, one for each of *args*, that 
+  all have the same length.
+  '''
+  n = sympy.Symbol('n',integer=True)
+  i = sympy.Idx(sympy.Symbol('i',integer=True),n)
+  out = sympy.IndexedBase('out')
+  arrays = [sympy.IndexedBase('in%s' % j) for j in range(len(args))]
+  if backend == 'cython':
+    code_gen = _CSECodeGen('autowrap')
+    helpers = [code_gen.routine('autofunc_scalar',expr,args)]
+    # the C code printer prints the undefined function as a call to 
+    # the helper routine
+    func = sympy.Function('autofunc_scalar')
+
+  elif backend == 'f2py':
+    code_gen = FCodeGen('autowrap')
+    helpers = []
+    # the Fortran code printer substitutes the expression for the 
+    # implemented function
+    func = implemented_function('autofunc_scalar',sympy.Lambda(args,expr))
+
+  else:
+    raise ValueError('Cannot compile functions with the %s backend' % backend)
+
+  code_wrapper = {'cython':_CythonCodeWrapper,'f2py':_F2PyCodeWrapper}[backend]
+  routine = code_gen.routine('autofunc',
+                             sympy.Eq(out[i],func(*[a[i] for a in arrays])),
+                             [out] + arrays + [n])
+  return code_wrapper(module_name,code_gen,tempdir).wrap_code(
+           routine,helpers=helpers)
+
+
+def _compile(args,expr,backend):
+  ''' 
+  Compiles *expr* with *_ufuncify* and the specified backend. The 
+  compiled extension module is stored in a subdirectory of *_CACHE_DIR* 
+  and it is imported from there if it already exists. 
+
+  The module is compiled in a private temporary directory, which is 
+  then renamed to the cache subdirectory. The rename is atomic, so 
+  other processes never see a partially written module. If another 
+  process has already stored the module then the temporary directory 
+  is discarded.
+  '''
+  key = _compile_key(args,expr,backend)
+  path = os.path.join(_CACHE_DIR,key)
+  func = _load_cached(path)
+  if func is not None:
+    return func
+
+  if not os.path.exists(_CACHE_DIR):
+    os.makedirs(_CACHE_DIR,exist_ok=True)
+
+  tempdir = tempfile.mkdtemp(dir=_CACHE_DIR)
+  logger.debug('Compiling function in %s ...' % tempdir)
+  try:
+    with _COMPILE_LOCK:
+      # name the extension module after *key* so that modules for 
+      # different functions never have the same name. Extension 
+      # modules with the same name cannot be imported together
+      func = _ufuncify(args,expr,backend,tempdir,'wrapper_module_' + key)
+
+  except Exception:
+    shutil.rmtree(tempdir,ignore_errors=True)
+    raise
+
+  try:
+    os.rename(tempdir,path)
+
+  except OSError:
+    # another process stored the module first. The module compiled 
+    # here has already been imported, so its files are not needed
+    shutil.rmtree(tempdir,ignore_errors=True)
+
+  logger.debug('Done')
+  return func
+
+
+def _precompile(rbfs,diffs):
+  ''' 
+  Creates the numerical functions for each RBF in *rbfs* and each 
+  derivative in *diffs*. The functions are created in a thread pool 
+  since most of the time is spent in the compiler. Each function is 
+  then evaluated once so that any just-in-time compilation also 
+  happens now. 
+  '''
+  with ThreadPoolExecutor() as executor:
+    futures = [executor.submit(r._add_diff_to_cache,d) 
+               for r in rbfs for d in diffs]
+
+  # raise any errors from the tasks
+  for f in futures:
+    f.result()
+
+  # numba holds the GIL while compiling, so there is no benefit to 
+  # evaluating the functions in the thread pool
+  for r in rbfs:
+    for d in diffs:
+      dim = len(d)
+      r._fast_call(np.zeros((1,dim)),np.zeros((1,dim)),np.ones(1),d)
+
+
+def _center_evaluator(func,lim_func,tol_func,radial):
+  ''' 
+  Returns a function with the call signature *f(x,c,eps)* which 
+  evaluates *func* and then replaces the values where *x* is within 
+  *tol_func(eps)* of *c* with *lim_func(eps)*. *lim_func* and 
+  *tol_func* are lambdified functions of *eps*. If *radial* is True 
+  then *func* is a radial evaluator, and the distances computed here 
+  are passed to it so that they are only computed once.
+  '''
+  def evaluate(x,c,eps):
+    r = cdist(x,c)
+    if radial:
+      out = func(x,c,eps,r=r)
+
+    else:
+      out = func(x,c,eps)
+
+    near_center = r < tol_func(eps)
+    np.copyto(out,lim_func(eps),where=near_center)
+    return out
+
+  return evaluate
+
+
+def _kernel_arguments(diff):
+  ''' 
+  Returns the total derivative order and the differentiated axes, 
+  *k* and *l*, which are passed to the kernels in *rbf._kernels*
+  '''
+  order = sum(diff)
+  axes = [i for i,d in enumerate(diff) for _ in range(d)]
+  k,l = (axes + [0,0])[:2]
+  return order,k,l
+
+
+def _kernel_evaluator(kernel,diff):
+  ''' 
+  Returns a function with the call signature *f(x,c,eps)* which 
+  evaluates the derivative *diff* of an RBF with a compiled kernel 
+  from *rbf._kernels*. *diff* must have a total order of at most two.
+  The kernel is evaluated in the precision of *x*.
+  '''
+  order,k,l = _kernel_arguments(diff)
+  def evaluate(x,c,eps):
+    if np.isscalar(eps):
+      # the kernels expect an array of shape parameters. Broadcasting 
+      # gives a zero-stride view of *eps* without allocating an array, 
+      # and numba compiles a separate version of the kernel for it
+      eps = np.broadcast_to(np.asarray(eps,dtype=x.dtype),(c.shape[0],))
+
+    out = np.empty((x.shape[0],c.shape[0]),dtype=x.dtype)
+    kernel(x,c,eps,order,k,l,out)
+    return out
+
+  return evaluate
+
+
+def _assert_stencil_shapes(x,c,eps,size,diff):
+  ''' 
+  Raises an error if the arguments for a function from 
+  *RBF.compile_for_stencil* do not have consistent shapes. The compiled 
+  kernels do not check bounds, so they would otherwise read past the 
+  end of the arrays.
+  '''
+  K = np.shape(x)[0]
+  D = len(diff)
+  _assert_shape(x,(K,None,D),'x')
+  _assert_shape(c,(K,size,D),'c')
+  _assert_shape(eps,(K,size),'eps')
+
+
+def _stencil_kernel_evaluator(kernel,size,diff):
+  ''' 
+  Returns a function with the call signature *f(x,c,eps)* which 
+  evaluates the derivative *diff* of an RBF for a batch of stencils 
+  with *size* nodes with a kernel from *rbf._kernels.stencil_kernel*.
+  '''
+  order,k,l = _kernel_arguments(diff)
+  def evaluate(x,c,eps):
+    _assert_stencil_shapes(x,c,eps,size,diff)
+    out = np.empty((x.shape[0],x.shape[1],c.shape[1]),dtype=float)
+    kernel(x,c,eps,order,k,l,out)
+    return out
+
+  return evaluate
+
+
 def get_r():
   ''' 
   returns the symbolic variable for :math:`r` which is used to 
@@ -173,6 +648,18 @@ class RBF(object):
     be searched before estimating the limit with the method describe
     above.
 
+  backend : str, optional
+    Backend used to convert the symbolic expressions into numerical 
+    functions. This can be 'numpy', 'cython', or 'f2py'. The 'numpy' 
+    backend uses *sympy.lambdify*, which evaluates the expression as a 
+    sequence of numpy functions. The other backends compile the 
+    expression with *sympy.utilities.autowrap*, and the compiled 
+    functions are stored in ~/.cache/rbf/ufuncs so that they can be 
+    reused. The 'numpy' and 'cython' backends only evaluate common 
+    subexpressions once. If compilation fails then the 'numpy' backend 
+    is used instead. Defaults to 'cython' if Cython is installed, and 
+    'numpy' otherwise.
+
   Examples
   --------
   Instantiate an inverse quadratic RBF
@@ -212,8 +699,12 @@ class RBF(object):
   
   Notes
   -----
-  It is safe to change the attributes *tol* and *limits*. Changes will
-  cause the cache of numerical functions to be cleared.
+  It is safe to change the attributes *tol*, *limits*, and *backend*. 
+  Changes to *tol* and *backend* will cause the RBF to use the 
+  numerical functions for the new attributes. Changes to *limits* will 
+  cause the numerical functions to be recreated when they are next 
+  needed, but only for the derivatives whose limits have changed. Call 
+  *clear_cache* to force all the numerical functions to be recreated.
   '''
   @property
   def expr(self):
@@ -228,6 +719,10 @@ class RBF(object):
   def limits(self):
     return self._limits
 
+  @property
+  def backend(self):
+    return self._backend
+
   @tol.setter
   def tol(self,value):
     if value is not None:
@@ -240,19 +735,34 @@ class RBF(object):
   
     self._tol = value
     # reset *cache* now that we have a new *tol*
-    self.clear_cache()
+    self._rebind_cache()
   
   @limits.setter
   def limits(self,value):
     if value is None:
       value = {}
       
-    # if *limits* is ever changed then *clear_cache* is called
-    self._limits = _CallbackDict(value,self.clear_cache)
+    # if *limits* is ever changed then its epoch is incremented, and 
+    # the numerical functions created at earlier epochs are replaced 
+    # when they are next needed
+    self._limits = _LimitsDict(value)
     # reset *cache* now that we have a new *limits*
-    self.clear_cache()
+    self._rebind_cache()
 
-  def __init__(self,expr,tol=None,limits=None):
+  @backend.setter
+  def backend(self,value):
+    if value is None:
+      value = _DEFAULT_BACKEND
+      
+    if value not in ('numpy','cython','f2py'):
+      raise ValueError(
+        '*backend* must be "numpy", "cython", or "f2py"')
+
+    self._backend = value
+    # reset *cache* now that we have a new *backend*
+    self._rebind_cache()
+
+  def __init__(self,expr,tol=None,limits=None,backend=None):
     # make sure that *expr* does not contain any symbols other than 
     # *_R* and *_EPS*
     other_symbols = expr.free_symbols.difference({_R,_EPS})
@@ -270,11 +780,16 @@ class RBF(object):
       expr = expr.subs(_R,_EPS*_R)
       
     self._expr = expr
+    # name of the compiled kernel in *rbf._kernels* for this RBF and 
+    # the limits it was registered with. This is only set for the 
+    # predefined RBFs
+    self._kernel = None
     self.tol = tol
     self.limits = limits
-    self.cache = {}
+    self.backend = backend
+    self._rebind_cache()
 
-  def __call__(self,x,c,eps=1.0,diff=None):
+  def __call__(self,x,c,eps=1.0,diff=None,dtype=float):
     ''' 
     Numerically evaluates the RBF or its derivatives.
     
@@ -296,25 +811,35 @@ class RBF(object):
       differentiating it twice along the first axis and once along the
       third axis.
 
+    dtype : data-type, optional
+      Floating point precision used to evaluate the RBF. Single 
+      precision (*np.float32*) halves the memory needed for large 
+      matrices and can be faster with the 'numpy' backend and the 
+      compiled kernels for the predefined RBFs. The 'cython' and 'f2py' 
+      backends always evaluate in double precision, and their output is 
+      cast to *dtype*. Defaults to *float*.
+
     Returns
     -------
-    out : (N,M) float array
+    out : (N,M) array with type *dtype*
       Returns the RBFs with centers *c* evaluated at *x*
 
     '''
-    x = np.asarray(x,dtype=float)
-    _assert_shape(x,(None,None),'x')
-    c = np.asarray(c,dtype=float)
-    _assert_shape(c,(None,x.shape[1]),'c')
+    x = np.asarray(x,dtype=dtype)
+    c = np.asarray(c,dtype=dtype)
+    if not _SKIP_CHECKS:
+      _assert_shape(x,(None,None),'x')
+      _assert_shape(c,(None,x.shape[1]),'c')
 
     if np.isscalar(eps):
-      # makes eps an array of constant values
-      eps = np.full(c.shape[0],eps,dtype=float)
+      # scalar shape parameters are passed to the numerical functions 
+      # as they are, rather than expanding them into an array
+      eps = float(eps)
 
     else:  
-      eps = np.asarray(eps,dtype=float)
-
-    _assert_shape(eps,(c.shape[0],),'eps')
+      eps = np.asarray(eps,dtype=dtype)
+      if not _SKIP_CHECKS:
+        _assert_shape(eps,(c.shape[0],),'eps')
 
     if diff is None:
       diff = (0,)*x.shape[1]
@@ -322,43 +847,173 @@ class RBF(object):
     else:
       # make sure diff is immutable
       diff = tuple(diff)
-    
-    _assert_shape(diff,(x.shape[1],),'diff')
 
-    # add numerical function to cache if not already
-    if diff not in self.cache:
-      self._add_diff_to_cache(diff)
+    if not _SKIP_CHECKS:
+      _assert_shape(diff,(x.shape[1],),'diff')
 
-    # expand to allow for broadcasting
-    x = x.T[:,:,None] 
-    c = c.T[:,None,:]
-    args = (tuple(x)+tuple(c)+(eps,))
-    out = self.cache[diff](*args)
+    out = self._fast_call(x,c,eps,diff)
+    out = out.astype(dtype,copy=False)
+    return out
+
+  def _fast_call(self,x,c,eps,diff):
+    ''' 
+    Evaluates the RBF without checking or converting the input. *x* 
+    and *c* must be (N,D) and (M,D) float arrays, *eps* must be a 
+    float or a (M,) float array, and *diff* must be a length D tuple. 
+    This is intended for functions that call the RBF repeatedly with 
+    input that is known to be valid (e.g. *rbf.fd.weights*).
+    '''
+    func = self._get_function(diff)
+    if ((not np.isscalar(eps)) and (eps.size > 0) and 
+        (eps == eps[0]).all()):
+      # If all the shape parameters are the same, then pass a scalar to 
+      # the numerical function. The numerical functions broadcast 
+      # scalars, and so any subexpressions of *eps* (e.g. eps**3) are 
+      # only evaluated once
+      eps = float(eps[0])
+
+    out = func(x,c,eps)
     return out
 
   def __repr__(self):
     out = '<RBF : %s>' % str(self.expr)
     return out
+
+  def compile_for_stencil(self,size,diff):
+    ''' 
+    Returns a function which evaluates the RBF, or its derivative 
+    *diff*, for a batch of stencils that each have *size* nodes. The 
+    function has the call signature *f(x,c,eps)*, where *x* is a 
+    (K,P,D) array of evaluation points for each stencil, *c* is a 
+    (K,size,D) array of stencil nodes, and *eps* is a (K,size) array 
+    of shape parameters. It returns a (K,P,size) array. A 
+    *ValueError* is raised if the shapes of the arguments are not 
+    consistent with *size* and *diff*.
+
+    If there is a compiled kernel for this RBF and derivative, then 
+    the function uses a kernel where *size* is a compile-time 
+    constant. The kernel is compiled the first time it is requested. 
+    Otherwise, the numerical function for *diff* is evaluated for each 
+    stencil.
+
+    Parameters
+    ----------
+    size : int
+      Number of nodes in each stencil
+
+    diff : (D,) int array
+      Derivative order for each Cartesian direction
+    
+    Returns
+    -------
+    out : function
+
+    '''
+    diff = tuple(diff)
+    name = self._kernel_name(diff)
+    if name is not None:
+      return _stencil_kernel_evaluator(stencil_kernel(name,size),size,diff)
+
+    def evaluate(x,c,eps):
+      _assert_stencil_shapes(x,c,eps,size,diff)
+      out = np.empty((x.shape[0],x.shape[1],size),dtype=float)
+      for i in range(x.shape[0]):
+        out[i] = self._fast_call(x[i],c[i],eps[i],diff)
+
+      return out
+
+    return evaluate
+
+  def _kernel_name(self,diff):
+    ''' 
+    Returns the name of the compiled kernel which evaluates the 
+    derivative *diff* of this RBF, or *None* if there is no suitable 
+    kernel. The kernels are only used for derivatives with a total 
+    order of at most two, and only if the limit for *diff* has not 
+    been changed from the limit the kernel was registered with.
+    '''
+    if self._kernel is None:
+      return None
+
+    name,limits = self._kernel
+    if sum(diff) > 2:
+      return None
+
+    if (self.tol is not None) and (self.limits.get(diff) != limits.get(diff)):
+      return None
+
+    return name
+
+  def _get_function(self,diff):
+    ''' 
+    Returns the numerical function for the derivative *diff*. The 
+    function is created if it is not in the cache or if *limits* has 
+    changed since it was created.
+    '''
+    item = self.cache.get(diff)
+    if (item is None) or (item[1] != self._limits.epoch):
+      self._add_diff_to_cache(diff)
+      item = self.cache[diff]
+
+    return item[0]
      
   def _add_diff_to_cache(self,diff):
+    ''' 
+    Adds the numerical function for the derivative *diff* to the 
+    cache, along with the epoch of *limits* when it was added. The 
+    function is taken from the cache shared with other RBFs if it has 
+    already been created for the same limit. Otherwise it is created 
+    with *_create_function*.
+    '''
+    diff = tuple(diff)
+    _assert_shape(diff,(None,),'diff')
+    epoch = self._limits.epoch
+    lim = self.limits.get(diff)
+    if lim is not None:
+      lim = sympy.srepr(sympy.sympify(lim))
+
+    key = (diff,lim)
+    func = self._shared_cache.get(key)
+    if func is None:
+      func = self._create_function(diff)
+      self._shared_cache[key] = func
+
+    self.cache[diff] = (func,epoch)
+
+  def _create_function(self,diff):
     '''     
     Symbolically differentiates the RBF and then converts the
-    expression to a function which can be evaluated numerically.
+    expression to a function which can be evaluated numerically. If 
+    there is a compiled kernel for this RBF and derivative, then that 
+    is used instead.
     '''   
-    diff = tuple(diff)
-    _assert_shape(diff,(None,),'diff')
+    name = self._kernel_name(diff)
+    if name is not None:
+      return _kernel_evaluator(KERNELS[name],diff)
 
     dim = len(diff)
-    c_sym = sympy.symbols('c:%s' % dim)
-    x_sym = sympy.symbols('x:%s' % dim)    
-    r_sym = sympy.sqrt(sum((xi-ci)**2 for xi,ci in zip(x_sym,c_sym)))
-    # differentiate the RBF 
-    expr = self.expr.subs(_R,r_sym)            
-    for xi,order in zip(x_sym,diff):
-      if order == 0:
-        continue
+    # if *diff* is all zeros then the RBF is a function of *r* only, and 
+    # the distances between points can be computed before evaluating 
+    # the expression
+    radial = not any(diff)
+    if radial:
+      r_sym = _R
+      expr = self.expr
+      args = (_R,_EPS)
+
+    else:
+      c_sym = sympy.symbols('c:%s' % dim)
+      x_sym = sympy.symbols('x:%s' % dim)    
+      r_sym = sympy.sqrt(sum((xi-ci)**2 for xi,ci in zip(x_sym,c_sym)))
+      # differentiate the RBF 
+      expr = self.expr.subs(_R,r_sym)            
+      for xi,order in zip(x_sym,diff):
+        if order == 0:
+          continue
 
-      expr = expr.diff(*(xi,)*order)
+        expr = expr.diff(*(xi,)*order)
+
+      args = x_sym + c_sym + (_EPS,)
 
     if self.tol is not None:
       if diff in self.limits:
@@ -366,35 +1021,137 @@ class RBF(object):
         lim = self.limits[diff]
 
       else: 
-        logger.debug('Estimating limit for the RBF center ...')
-        # make the substitutions for the point
-        # (x0=tol+c0, x1=c1, x2=c2, ...)
-        subs_list  = [(x_sym[0],self.tol+c_sym[0])]
-        subs_list += zip(x_sym[1:],c_sym[1:])
-        # evaluate the RBF and its derivative at that point
-        a = expr.subs(subs_list) 
-        b = expr.diff(x_sym[0]).subs(subs_list)
-        # form a linear polynomial and evaluate it at x=c
-        lim = a - self.tol*b
-        # try to simplify the expression to reduce numerical rounding
-        # error. Note that this should only be a function of *eps* now
-        # and the simplification should not take long
-        lim = sympy.cancel(lim) 
-        logger.debug('Done')
+        lim = self._estimated_limits.get(diff)
+        if lim is None:
+          logger.debug('Estimating limit for the RBF center ...')
+          if radial:
+            # the RBF is already a function of *r*
+            var = _R
+            line = expr
+
+          else:
+            # restrict the expression to the line through the center 
+            # along the first axis (x0=t+c0, x1=c1, x2=c2, ...). This 
+            # is a function of *t* and *eps* only, and it is much 
+            # cheaper to differentiate than *expr*
+            var = sympy.Dummy('t')
+            subs_list  = [(x_sym[0],var+c_sym[0])]
+            subs_list += zip(x_sym[1:],c_sym[1:])
+            line = expr.subs(subs_list)
+
+          # evaluate the RBF and its derivative at *tol*
+          a = line.subs(var,self.tol) 
+          b = line.diff(var).subs(var,self.tol)
+          # form a linear polynomial and evaluate it at the center
+          lim = a - self.tol*b
+          # try to simplify the expression to reduce numerical rounding
+          # error. Note that this should only be a function of *eps* 
+          # now and the simplification should not take long
+          lim = sympy.cancel(lim) 
+          self._estimated_limits[diff] = lim
+          logger.debug('Done')
+
+      lim = sympy.sympify(lim)
+      if lim.free_symbols.issubset({_EPS}):
+        # *lim* does not depend on the evaluation points, so the 
+        # expression is evaluated for all points and then the values 
+        # within *tol* of the center are replaced with *lim*. This 
+        # avoids evaluating a branch for each point
+        func = self._numerical_function(args,expr,radial)
+        lim_func = sympy.lambdify((_EPS,),lim,modules=['numpy'])
+        tol_func = sympy.lambdify((_EPS,),self.tol,modules=['numpy'])
+        return _center_evaluator(func,lim_func,tol_func,radial)
 
       # create a piecewise symbolic function which is *lim* when *r_sym*<*tol*
       # and *expr* otherwise
       expr = sympy.Piecewise((lim,r_sym<self.tol),(expr,True)) 
       
-    func = ufuncify(x_sym+c_sym+(_EPS,),expr,backend='numpy')
-    self.cache[diff] = func
+    return self._numerical_function(args,expr,radial)
+
+  def _numerical_function(self,args,expr,radial):
+    ''' 
+    Converts *expr* into a function with the call signature 
+    *f(x,c,eps)* using the backend for this RBF. *args* are the 
+    symbolic arguments for *expr*, and *radial* indicates whether they 
+    are *r* and *eps*.
+    '''
+    if self.backend != 'numpy':
+      key = _compile_key(args,expr,self.backend)
+      if key not in _FAILED_COMPILES:
+        try:
+          func = _compile(args,expr,self.backend)
+          if radial:
+            return _radial_compiled_evaluator(func)
+
+          else:
+            return _compiled_evaluator(func)
+
+        except Exception as err:
+          # the compiler or Cython may not be available, or the 
+          # backend may not support *expr*. Fall back to the numpy 
+          # backend for this function
+          warnings.warn(
+            'Failed to compile a function with the %s backend. The '
+            'numpy backend will be used instead. The error was: %s' % 
+            (self.backend,repr(err)))
+          _FAILED_COMPILES.add(key)
+
+    # eliminate common subexpressions so that each of them is only 
+    # evaluated once by the lambdified function
+    func = sympy.lambdify(args,expr,modules=['numpy'],cse=True)
+    if radial:
+      return _radial_evaluator(func)
+
+    else:
+      return _lambdified_evaluator(func)
     
-  def clear_cache(self):
+  def _cache_key(self):
     ''' 
-    Clears the cache of numerical functions. Makes a cache dictionary
-    if it does not already exist
+    Returns a hashable key which identifies the numerical functions 
+    for this RBF. *limits* is not part of the key because the limits 
+    are included in the keys of the shared cache.
+    '''
+    kernel = None if self._kernel is None else self._kernel[0]
+    key = (sympy.srepr(self.expr),sympy.srepr(self.tol),self.backend,
+           kernel)
+    return key
+
+  def _rebind_cache(self):
+    ''' 
+    Empties the cache of numerical functions for this RBF and replaces 
+    the shared caches with the ones for the current *tol* and 
+    *backend*. The shared caches are used by all other RBFs that have 
+    the same expression and attributes, so that the numerical 
+    functions and estimated limits are only created once.
     '''
     self.cache = {}
+    try:
+      key = self._cache_key()
+
+    except AttributeError:
+      # this is called by the setters in *__init__* before all the 
+      # attributes are set
+      self._shared_cache = _SharedDict()
+      self._estimated_limits = _SharedDict()
+      return
+      
+    self._shared_cache = _shared(_CACHES,key)
+    self._estimated_limits = _shared(
+      _ESTIMATED_LIMITS,(sympy.srepr(self.expr),sympy.srepr(self.tol)))
+
+  def clear_cache(self):
+    ''' 
+    Clears the numerical functions and estimated limits for this RBF, 
+    including those shared with other RBFs that have the same 
+    expression and attributes. They are recreated when they are next 
+    needed. Other RBFs keep the functions they have already used until 
+    their own *clear_cache* is called. Functions compiled with the 
+    'cython' or 'f2py' backends are reloaded from *_CACHE_DIR* rather 
+    than compiled again.
+    '''
+    self._rebind_cache()
+    self._shared_cache.clear()
+    self._estimated_limits.clear()
     
 
 class SparseRBF(RBF):
@@ -439,6 +1196,10 @@ class SparseRBF(RBF):
     this dictionary is provided and *tol* is not *None*, then it will
     be searched before numerically estimating the limit.
 
+  backend : str, optional
+    Backend used to convert the symbolic expressions into numerical 
+    functions. This can be 'numpy', 'cython', or 'f2py'.
+
   ''' 
   @property
   def supp(self):
@@ -455,7 +1216,7 @@ class SparseRBF(RBF):
   
     self._supp = value
     # reset *cache* now that we have a new *supp*
-    self.clear_cache()
+    self._rebind_cache()
   
   def __init__(self,expr,supp,**kwargs):
     self.supp = supp      
@@ -498,9 +1259,6 @@ class SparseRBF(RBF):
       raise NotImplementedError(
         '*eps* must be a scalar for *SparseRBF* instances')
 
-    # convert scalar to (1,) array
-    eps = np.array([eps],dtype=float)
-
     if diff is None:
       diff = (0,)*x.shape[1]
 
@@ -509,10 +1267,18 @@ class SparseRBF(RBF):
       diff = tuple(diff)
     
     _assert_shape(diff,(x.shape[1],),'diff')
+    out = self._fast_call(x,c,eps,diff)
+    return out
 
-    # add numerical function to cache if not already
-    if diff not in self.cache:
-      self._add_diff_to_cache(diff)
+  def _fast_call(self,x,c,eps,diff):
+    ''' 
+    Evaluates the RBF without checking or converting the input. *x* 
+    and *c* must be (N,D) and (M,D) float arrays, *eps* must be a 
+    float, and *diff* must be a length D tuple. 
+    '''
+    func = self._get_function(diff)
+    # convert scalar to (1,) array
+    eps = np.array([eps],dtype=float)
 
     # convert self.supp from a sympy expression to a float
     supp = float(self.supp.subs(_EPS,eps[0]))
@@ -536,11 +1302,7 @@ class SparseRBF(RBF):
     for i,idxi in enumerate(idx):
       # *m* is the number of nodes in *x* close to *c[[i]]*
       m = len(idxi)
-      # properly shape *x* and *c* for broadcasting
-      xi = x.T[:,idxi,None]
-      ci = c.T[:,None,i][:,:,None]
-      args = (tuple(xi) + tuple(ci) + (eps,))
-      data[n:n+m] = self.cache[diff](*args)[:,0]
+      data[n:n+m] = func(x[idxi],c[[i]],eps)[:,0]
       rows[n:n+m] = idxi
       cols[n:n+m] = i
       n += m
@@ -597,35 +1359,31 @@ spwen30 = SparseRBF(           (1 - _R/_EPS)**2
 spwen31 = SparseRBF(           (1 - _R/_EPS)**4*(4*_R/_EPS + 1)                          , _EPS, tol=sympy.Float('1e-10',50)*_EPS)
 spwen32 = SparseRBF(           (1 - _R/_EPS)**6*(35*_R**2/_EPS**2 + 18*_R/_EPS + 3)/3    , _EPS, tol=sympy.Float('1e-10',50)*_EPS)
 
-# set some known RBF limits
-phs1.limits.update((tuple(i),0) for i in powers(0,1))
-phs1.limits.update((tuple(i),0) for i in powers(0,2))
-phs1.limits.update((tuple(i),0) for i in powers(0,3))
-
-phs2.limits.update((tuple(i),0) for i in powers(1,1))
-phs2.limits.update((tuple(i),0) for i in powers(1,2))
-phs2.limits.update((tuple(i),0) for i in powers(1,3))
-
-phs3.limits.update((tuple(i),0) for i in powers(2,1))
-phs3.limits.update((tuple(i),0) for i in powers(2,2))
-phs3.limits.update((tuple(i),0) for i in powers(2,3))
-
-phs4.limits.update((tuple(i),0) for i in powers(3,1))
-phs4.limits.update((tuple(i),0) for i in powers(3,2))
-phs4.limits.update((tuple(i),0) for i in powers(3,3))
-
-phs5.limits.update((tuple(i),0) for i in powers(4,1))
-phs5.limits.update((tuple(i),0) for i in powers(4,2))
-phs5.limits.update((tuple(i),0) for i in powers(4,3))
-
-phs6.limits.update((tuple(i),0) for i in powers(5,1))
-phs6.limits.update((tuple(i),0) for i in powers(5,2))
-phs6.limits.update((tuple(i),0) for i in powers(5,3))
-
-phs7.limits.update((tuple(i),0) for i in powers(6,1))
-phs7.limits.update((tuple(i),0) for i in powers(6,2))
-phs7.limits.update((tuple(i),0) for i in powers(6,3))
-
-phs8.limits.update((tuple(i),0) for i in powers(7,1))
-phs8.limits.update((tuple(i),0) for i in powers(7,2))
-phs8.limits.update((tuple(i),0) for i in powers(7,3))
+# set some known RBF limits. The derivatives of *phsN* with total 
+# order less than N are zero at the center in one, two, and three 
+# dimensions. Each dictionary is assigned at once so that *limits* is 
+# only replaced once per RBF
+phs1.limits = {tuple(i):0 for n in (1,2,3) for i in powers(0,n)}
+phs2.limits = {tuple(i):0 for n in (1,2,3) for i in powers(1,n)}
+phs3.limits = {tuple(i):0 for n in (1,2,3) for i in powers(2,n)}
+phs4.limits = {tuple(i):0 for n in (1,2,3) for i in powers(3,n)}
+phs5.limits = {tuple(i):0 for n in (1,2,3) for i in powers(4,n)}
+phs6.limits = {tuple(i):0 for n in (1,2,3) for i in powers(5,n)}
+phs7.limits = {tuple(i):0 for n in (1,2,3) for i in powers(6,n)}
+phs8.limits = {tuple(i):0 for n in (1,2,3) for i in powers(7,n)}
+
+# register the compiled kernels in *rbf._kernels* with the predefined 
+# RBFs. No kernels are registered if numba is not available
+for _rbf,_name in [(ga,'ga'),(iq,'iq'),(imq,'imq'),(mq,'mq'),
+                   (phs3,'phs3'),(phs5,'phs5'),(phs7,'phs7')]:
+  if _name in KERNELS:
+    _rbf._kernel = (_name,dict(_rbf.limits))
+    _rbf._rebind_cache()
+
+# If the environment variable *RBF_PRECOMPILE* is set to 1 then the 
+# numerical functions for the commonly used RBFs and derivatives are 
+# created when this module is imported, rather than when they are first 
+# needed
+if os.environ.get('RBF_PRECOMPILE','0') == '1':
+  _precompile((ga,iq,imq,mq,phs3,phs5),
+              [(0,0),(1,0),(0,1),(2,0),(0,2),(1,1)])
@@ -7,8 +7,14 @@ import rbf.basis
 import rbf.poly
 import rbf.stencil
 import rbf._lapack
+import rbf.mp
 import scipy.sparse
 
+# number of stencils whose RBFs are evaluated together in 
+# *weight_matrix*
+_BLOCK_SIZE = 1000
+
+
 def _reshape_diffs(diffs):
   ''' 
   turns diffs into a 2D array
@@ -54,10 +60,29 @@ def _max_poly_order(size,dim):
   return order
 
 
-def _lhs(s,eps,powers,basis):
+def _poly_order(order,diffs,size,dim):
+  ''' 
+  Returns the polynomial order for stencils with *size* nodes. If 
+  *order* is None then the default polynomial order is used, and 
+  otherwise an error is raised if *order* is too high.
+  '''
+  max_order = _max_poly_order(size,dim)
+  if order is None:
+    order = _default_poly_order(diffs)
+    order = min(order,max_order)
+
+  if order > max_order:
+    raise ValueError(
+      'Polynomial order is too high for the stencil size')
+
+  return order
+
+
+def _lhs(s,eps,powers,basis,phi=None):
   ''' 
   Returns the transposed RBF alternant matrix with added polynomial 
-  terms and constraints
+  terms and constraints. *phi* is the RBF evaluated at *s*, if it 
+  has already been computed
   '''
   # number of nodes in the stencil and the number of dimensions
   Ns,Ndim = s.shape
@@ -65,29 +90,62 @@ def _lhs(s,eps,powers,basis):
   Np = powers.shape[0]
   # deriviative orders
   diff = np.zeros(Ndim,dtype=int)
+  if phi is None:
+    phi = basis._fast_call(s,s,eps,tuple(diff))
+
   A = np.zeros((Ns+Np,Ns+Np),dtype=float)
-  A[:Ns,:Ns] = basis(s,s,eps=eps,diff=diff).T
+  A[:Ns,:Ns] = phi.T
   Ap = rbf.poly.mvmonos(s,powers,diff=diff)
   A[Ns:,:Ns] = Ap.T
   A[:Ns,Ns:] = Ap
   return A
 
 
-def _rhs(x,s,eps,powers,diff,basis): 
+def _rhs(x,s,eps,powers,diff,basis,phi=None): 
   ''' 
-  Returns the differentiated RBF and polynomial terms evaluated at x
+  Returns the differentiated RBF and polynomial terms evaluated at x. 
+  *phi* is the differentiated RBF evaluated at x, if it has already 
+  been computed
   '''
   x = x[None,:]
   # number of nodes in the stencil and the number of dimensions
   Ns,Ndim = s.shape
   # number of monomial terms
   Np = powers.shape[0]
+  if phi is None:
+    phi = basis._fast_call(x,s,eps,tuple(diff))[0,:]
+
   d = np.empty(Ns+Np,dtype=float)
-  d[:Ns] = basis(x,s,eps=eps,diff=diff)[0,:]
+  d[:Ns] = phi
   d[Ns:] = rbf.poly.mvmonos(x,powers,diff=diff)[0,:]
   return d
 
 
+def _solve(lhs,rhs,x,s,use_pinv):
+  ''' 
+  Solves for the RBF-FD weights for the stencil *s* and the target 
+  point *x*
+  '''
+  N = s.shape[0]
+  if use_pinv:
+    out = np.linalg.pinv(lhs).dot(rhs)[:N]
+
+  else:  
+    try:
+      out = rbf._lapack.solve(lhs,rhs)[:N]
+    
+    except np.linalg.LinAlgError:
+      raise np.linalg.LinAlgError(
+        'Cannot uniquely solve for the RBF-FD weights for point %s. '
+        'Make sure that the stencil meets the conditions for '
+        'non-singularity. This error may also be due to numerically '
+        'flat basis functions. To ignore this error and solve for '
+        'the weights with a pseudo-inversion, set *use_pinv* to True.'
+        '\n\nThe stencil contains the following nodes:\n%s' % (x,s))
+
+  return out
+
+
 def weights(x,s,diffs,coeffs=None,
             basis=rbf.basis.phs3,order=None,
             eps=1.0,use_pinv=False):
@@ -190,6 +248,14 @@ def weights(x,s,diffs,coeffs=None,
   diffs = _reshape_diffs(diffs)
   # stencil size and number of dimensions
   N,D = s.shape
+  # the RBFs are evaluated without checking their input in *_lhs* and 
+  # *_rhs*, so make sure that *eps* is a float or a (N,) array here
+  if np.isscalar(eps):
+    eps = float(eps)
+  else:
+    eps = np.asarray(eps,dtype=float)
+    rbf.basis._assert_shape(eps,(N,),'eps')
+
   if coeffs is None:
     coeffs = np.ones(diffs.shape[0],dtype=float)
   else:
@@ -197,15 +263,7 @@ def weights(x,s,diffs,coeffs=None,
     if (coeffs.ndim != 1) | (coeffs.shape[0] != diffs.shape[0]):
       raise ValueError('*coeffs* and *diffs* have incompatible shapes')
 
-  max_order = _max_poly_order(N,D)
-  if order is None:
-    order = _default_poly_order(diffs)
-    order = min(order,max_order)
-
-  if order > max_order:
-    raise ValueError(
-      'Polynomial order is too high for the stencil size')
-    
+  order = _poly_order(order,diffs,N,D)
   powers = rbf.poly.powers(order,D)
   # left hand side
   lhs = _lhs(s,eps,powers,basis)
@@ -213,29 +271,14 @@ def weights(x,s,diffs,coeffs=None,
   for c,d in zip(coeffs,diffs):
     rhs += c*_rhs(x,s,eps,powers,d,basis)
 
-  if use_pinv:
-    out = np.linalg.pinv(lhs).dot(rhs)[:N]
-
-  else:  
-    try:
-      out = rbf._lapack.solve(lhs,rhs)[:N]
-    
-    except np.linalg.LinAlgError:
-      raise np.linalg.LinAlgError(
-        'Cannot uniquely solve for the RBF-FD weights for point %s. '
-        'Make sure that the stencil meets the conditions for '
-        'non-singularity. This error may also be due to numerically '
-        'flat basis functions. To ignore this error and solve for '
-        'the weights with a pseudo-inversion, set *use_pinv* to True.'
-        '\n\nThe stencil contains the following nodes:\n%s' % (x,s))
-
+  out = _solve(lhs,rhs,x,s,use_pinv)
   return out
 
 
 def weight_matrix(x,p,diffs,coeffs=None,
                   basis=rbf.basis.phs3,order=None,
                   eps=1.0,n=None,vert=None,smp=None,
-                  use_pinv=False):
+                  use_pinv=False,procs=0,coo=False):
   ''' 
   Returns a weight matrix which maps a functions values at *p* to an 
   approximation of that functions derivative at *x*.  This is a 
@@ -294,9 +337,20 @@ def weight_matrix(x,p,diffs,coeffs=None,
     weights. This should be used for stencils where the weights cannot 
     be uniquely resolved (e.g. when there are duplicate nodes).
 
+  procs : int, optional
+    Distribute the stencils among this many subprocesses. This 
+    defaults to 0 (i.e. the parent process computes all the weights).
+
+  coo : bool, optional
+    If True then the weight matrix is returned in coordinate (COO) 
+    format. The *data*, *row*, and *col* attributes of COO matrices 
+    can be concatenated to assemble a larger sparse matrix with a 
+    single conversion to CSR format, rather than stacking CSR 
+    matrices.
+
   Returns
   -------
-  L : (N,M) csr sparse matrix          
+  L : (N,M) csr sparse matrix or coo sparse matrix if *coo* is True
       
   Examples
   --------
@@ -344,18 +398,53 @@ def weight_matrix(x,p,diffs,coeffs=None,
   else:
     sn = rbf.stencil.stencil_network(x,p,n,vert=vert,smp=smp)
   
-  # values that will be put into the sparse matrix
-  data = np.zeros(sn.shape,dtype=float)
-  for i,si in enumerate(sn):
-    data[i,:] = weights(x[i],p[si],diffs,
-                        coeffs=coeffs[:,i],eps=eps[si],
-                        basis=basis,order=order,
-                        use_pinv=use_pinv)
+  # all the stencils have the same size, so the RBFs are evaluated 
+  # with functions that are specialized for that size
+  size,dim = sn.shape[1],x.shape[1]
+  powers = rbf.poly.powers(_poly_order(order,diffs,size,dim),dim)
+  lhs_func = basis.compile_for_stencil(size,(0,)*dim)
+  rhs_funcs = [basis.compile_for_stencil(size,d) for d in diffs]
+  # create the numerical functions now, rather than when they are 
+  # first evaluated, so that the subprocesses inherit them instead of 
+  # each compiling the same functions
+  for d in [(0,)*dim] + [tuple(d) for d in diffs]:
+    basis._get_function(d)
+
+  def stencil_weights(idx):
+    # computes the weights for the stencils with indices *idx*
+    out = np.zeros((len(idx),size),dtype=float)
+    # evaluate the RBFs for blocks of stencils at once. The blocks 
+    # limit the memory used for the RBF values
+    for start in range(0,len(idx),_BLOCK_SIZE):
+      block = idx[start:start + _BLOCK_SIZE]
+      s = p[sn[block]]
+      e = eps[sn[block]]
+      lhs_phi = lhs_func(s,s,e)
+      rhs_phi = [f(x[block,None,:],s,e)[:,0,:] for f in rhs_funcs]
+      for j,i in enumerate(block):
+        lhs = _lhs(s[j],e[j],powers,basis,phi=lhs_phi[j])
+        rhs = np.zeros(size + powers.shape[0],dtype=float)
+        for c,d,phi in zip(coeffs[:,i],diffs,rhs_phi):
+          rhs += c*_rhs(x[i],s[j],e[j],powers,d,basis,phi=phi[j])
+
+        out[start + j,:] = _solve(lhs,rhs,x[i],s[j],use_pinv)
+
+    return out
+
+  # values that will be put into the sparse matrix. The stencils are 
+  # split into one group for each subprocess
+  groups = np.array_split(np.arange(sn.shape[0]),max(procs,1))
+  data = np.vstack(rbf.mp.parmap(stencil_weights,groups,workers=procs))
 
   rows = np.repeat(range(data.shape[0]),data.shape[1])
   cols = sn.ravel()
   data = data.ravel()
   shape = x.shape[0],p.shape[0]
-  L = scipy.sparse.csr_matrix((data,(rows,cols)),shape)
+  if coo:
+    L = scipy.sparse.coo_matrix((data,(rows,cols)),shape)
+
+  else:
+    L = scipy.sparse.csr_matrix((data,(rows,cols)),shape)
+
   return L
                 
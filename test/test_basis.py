@@ -4,6 +4,13 @@ import numpy as np
 import matplotlib.pyplot as plt
 import sympy
 import unittest
+import warnings
+import tempfile
+import shutil
+import importlib.machinery
+import glob
+import os
+import gc
 
 def test_odd_phs(func):
   ''' 
@@ -102,5 +109,264 @@ class Test(unittest.TestCase):
     check = np.all(np.isclose(out1,out2))
     self.assertTrue(check)
 
+  def test_second_derivative(self):
+    # compare the second derivatives with finite differences of the 
+    # first derivatives
+    dx = 1e-6
+    x1 = np.array([[1.2,3.3]])
+    x2 = np.array([[1.2+dx,3.3]])
+    c = np.array([[0.5,2.1]])
+    eps = np.array([0.3])
+    for func in [rbf.basis.phs3,rbf.basis.phs5,rbf.basis.phs7,
+                 rbf.basis.ga,rbf.basis.imq,rbf.basis.mq,
+                 rbf.basis.iq]:
+      for diff in [(1,0),(0,1)]:
+        u1 = func(x1,c,eps=eps,diff=diff)
+        u2 = func(x2,c,eps=eps,diff=diff)
+        diff_num = (u2 - u1)/dx
+        diff_true = func(x1,c,eps=eps,diff=(diff[0]+1,diff[1]))
+        self.assertTrue(np.isclose(diff_num[0,0],diff_true[0,0],rtol=1e-4))
+
+  def test_backends(self):
+    # make sure that the compiled and lambdified functions agree
+    if rbf.basis._DEFAULT_BACKEND != 'cython':
+      self.skipTest('Cython is not available')
+
+    np.random.seed(1)
+    x = np.random.random((5,2))
+    c = np.random.random((3,2))
+    c[0] = x[0]
+    eps = np.random.random(3,)
+    # compile the functions in a temporary directory rather than the 
+    # user's cache
+    cache_dir = rbf.basis._CACHE_DIR
+    rbf.basis._CACHE_DIR = tempfile.mkdtemp()
+    try:
+      # make sure that the cython function is not silently replaced 
+      # with the numpy function
+      with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        for diff in [(0,0),(1,0),(1,1)]:
+          out = []
+          for backend in ['numpy','cython']:
+            phs2 = rbf.basis.RBF(rbf.basis.phs2.expr,
+                                 tol=rbf.basis.phs2.tol,
+                                 backend=backend)
+            out += [phs2(x,c,eps=eps,diff=diff)]
+
+          self.assertTrue(np.all(np.isclose(out[0],out[1])))
+
+    finally:
+      shutil.rmtree(rbf.basis._CACHE_DIR)
+      rbf.basis._CACHE_DIR = cache_dir
+
+  def test_failed_compile(self):
+    # a function which fails to compile should be evaluated with the 
+    # numpy backend without preventing other functions from being 
+    # compiled
+    if rbf.basis._DEFAULT_BACKEND != 'cython':
+      self.skipTest('Cython is not available')
+
+    r = rbf.basis.get_r()
+    x = np.array([[0.0],[1.0]])
+    c = np.array([[2.0]])
+    cache_dir = rbf.basis._CACHE_DIR
+    tempdir = tempfile.mkdtemp()
+    # the cache directory cannot be created inside of a file
+    open(os.path.join(tempdir,'file'),'w').close()
+    rbf.basis._CACHE_DIR = os.path.join(tempdir,'file','ufuncs')
+    try:
+      rbf1 = rbf.basis.RBF(r**3 + 2*r,backend='cython')
+      with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        out = rbf1(x,c)
+        self.assertEqual(len(w),1)
+        
+      self.assertTrue(np.allclose(out,[[12.0],[3.0]]))
+      rbf.basis._CACHE_DIR = os.path.join(tempdir,'ufuncs')
+      rbf2 = rbf.basis.RBF(r**3 + 3*r,backend='cython')
+      with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        out = rbf2(x,c)
+        
+      self.assertTrue(np.allclose(out,[[14.0],[4.0]]))
+
+    finally:
+      shutil.rmtree(tempdir)
+      rbf.basis._CACHE_DIR = cache_dir
+
+  def test_corrupt_cache(self):
+    # a module in the cache which cannot be imported should be 
+    # compiled again, rather than disabling the backend
+    if rbf.basis._DEFAULT_BACKEND != 'cython':
+      self.skipTest('Cython is not available')
+
+    r = rbf.basis.get_r()
+    eps = rbf.basis.get_eps()
+    args = (r,eps)
+    expr = sympy.exp(-eps*r)*(r + 3)
+    cache_dir = rbf.basis._CACHE_DIR
+    rbf.basis._CACHE_DIR = tempfile.mkdtemp()
+    try:
+      key = rbf.basis._compile_key(args,expr,'cython')
+      path = os.path.join(rbf.basis._CACHE_DIR,key)
+      os.makedirs(path)
+      # write an empty extension module
+      suffix = importlib.machinery.EXTENSION_SUFFIXES[0]
+      open(os.path.join(path,'wrapper_module_0' + suffix),'w').close()
+      func = rbf.basis._compile(args,expr,'cython')
+      out = func(np.array([1.0]),np.array([2.0]))
+      self.assertTrue(np.isclose(out[0],4.0*np.exp(-2.0)))
+      # the module should now be loaded from the cache
+      self.assertTrue(rbf.basis._load_cached(path) is not None)
+
+    finally:
+      shutil.rmtree(rbf.basis._CACHE_DIR)
+      rbf.basis._CACHE_DIR = cache_dir
+
+  def test_compiled_cse(self):
+    # the compiled cython function should evaluate common
+    # subexpressions once and agree with the lambdified function
+    if rbf.basis._DEFAULT_BACKEND != 'cython':
+      self.skipTest('Cython is not available')
+
+    x = sympy.symbols('x:2')
+    c = sympy.symbols('c:2')
+    eps = rbf.basis.get_eps()
+    args = x + c + (eps,)
+    r = sympy.sqrt((x[0] - c[0])**2 + (x[1] - c[1])**2)
+    expr = rbf.basis.mat52.expr.subs(rbf.basis.get_r(),r)
+    expr = expr.diff(x[0]).diff(x[1])
+    cache_dir = rbf.basis._CACHE_DIR
+    rbf.basis._CACHE_DIR = tempfile.mkdtemp()
+    try:
+      func = rbf.basis._compile(args,expr,'cython')
+      np.random.seed(1)
+      vals = [np.random.random(10) for a in args]
+      out1 = func(*vals)
+      out2 = sympy.lambdify(args,expr,modules=['numpy'])(*vals)
+      self.assertTrue(np.all(np.isclose(out1,out2)))
+      # the generated C code should assign the common subexpressions
+      # to temporary variables
+      key = rbf.basis._compile_key(args,expr,'cython')
+      path = os.path.join(rbf.basis._CACHE_DIR,key)
+      code = ''.join(open(f).read() for f in
+                     glob.glob(os.path.join(path,'wrapped_code_*.c')))
+      self.assertTrue('const double x' in code)
+
+    finally:
+      shutil.rmtree(rbf.basis._CACHE_DIR)
+      rbf.basis._CACHE_DIR = cache_dir
+
+  def test_shared_cache(self):
+    # RBFs with the same expression and attributes should share their 
+    # numerical functions
+    x = np.array([[0.0,0.0],[1.0,1.0]])
+    phs2 = rbf.basis.phs2
+    new_phs2 = rbf.basis.RBF(phs2.expr,tol=phs2.tol,
+                             limits=dict(phs2.limits))
+    phs2(x,x,diff=(1,0))
+    new_phs2(x,x,diff=(1,0))
+    self.assertTrue(new_phs2.cache[(1,0)][0] is phs2.cache[(1,0)][0])
+    # changing a limit should only replace the function for that 
+    # derivative
+    new_phs2(x,x,diff=(0,1))
+    func = new_phs2.cache[(0,1)][0]
+    new_phs2.limits[(1,0)] = 5.0
+    out = new_phs2(x,x,diff=(1,0))
+    self.assertTrue(np.all(np.diag(out) == 5.0))
+    self.assertTrue(new_phs2.cache[(1,0)][0] is not phs2.cache[(1,0)][0])
+    new_phs2(x,x,diff=(0,1))
+    self.assertTrue(new_phs2.cache[(0,1)][0] is func)
+
+  def test_clear_cache(self):
+    # *clear_cache* should force the numerical functions to be 
+    # recreated, and the shared caches should be discarded when no RBF 
+    # uses them
+    x = np.array([[0.0,0.0],[1.0,1.0]])
+    r = rbf.basis.get_r()
+    eps = rbf.basis.get_eps()
+    phi = rbf.basis.RBF(sympy.exp(-(eps*r)**3),backend='numpy')
+    phi(x,x)
+    func = phi.cache[(0,0)][0]
+    phi.clear_cache()
+    phi(x,x)
+    self.assertTrue(phi.cache[(0,0)][0] is not func)
+    key = phi._cache_key()
+    self.assertTrue(key in rbf.basis._CACHES)
+    del phi
+    gc.collect()
+    self.assertTrue(key not in rbf.basis._CACHES)
+
+  def test_constant_derivative(self):
+    # the lambdified function returns a scalar for constant 
+    # expressions. Make sure the output still has shape (N,M)
+    x = np.array([[-1.0],[0.0],[1.0]])
+    c = np.array([[0.0],[2.0]])
+    out = rbf.basis.phs1(x,c,diff=(2,))
+    self.assertTrue(out.shape == (3,2))
+    self.assertTrue(np.all(out == 0.0))
+
+  def test_user_limits(self):
+    # user-specified limits should be used even when the expression is 
+    # the same as a predefined RBF with a compiled kernel
+    x = np.zeros((1,2))
+    phs3 = rbf.basis.phs3
+    new_phs3 = rbf.basis.RBF(phs3.expr,tol=phs3.tol,limits={(0,0):7.0})
+    self.assertTrue(new_phs3(x,x)[0,0] == 7.0)
+    self.assertTrue(new_phs3.compile_for_stencil(1,(0,0))(
+      x[None],x[None],np.ones((1,1)))[0,0,0] == 7.0)
+    # changing a limit of a predefined RBF should also bypass its 
+    # kernel
+    phs3.limits[(0,0)] = 7.0
+    try:
+      self.assertTrue(phs3(x,x)[0,0] == 7.0)
+
+    finally:
+      phs3.limits[(0,0)] = 0
+
+    self.assertTrue(phs3(x,x)[0,0] == 0.0)
+
+  def test_compile_for_stencil(self):
+    # the stencil functions should agree with evaluating the RBF for 
+    # each stencil
+    np.random.seed(1)
+    x = np.random.random((4,1,2))
+    c = np.random.random((4,6,2))
+    eps = np.random.random((4,6))
+    for phi in [rbf.basis.phs2,rbf.basis.phs3,rbf.basis.ga]:
+      for diff in [(0,0),(1,0),(1,1),(0,2)]:
+        out = phi.compile_for_stencil(6,diff)(x,c,eps)
+        for i in range(4):
+          soln = phi(x[i],c[i],eps=eps[i],diff=diff)
+          self.assertTrue(np.allclose(out[i],soln))
+
+  def test_compile_for_stencil_shape(self):
+    # the stencil functions should raise an error if the arguments are 
+    # not consistent with the stencil size, rather than reading out of 
+    # bounds
+    x = np.zeros((4,1,2))
+    c = np.zeros((4,5,2))
+    eps = np.ones((4,5))
+    for phi in [rbf.basis.phs3,rbf.basis.mat32]:
+      func = phi.compile_for_stencil(6,(1,0))
+      self.assertRaises(ValueError,func,x,c,eps)
+      self.assertRaises(ValueError,func,x,np.zeros((4,6,2)),eps)
+      self.assertRaises(ValueError,func,np.zeros((4,1,3)),
+                        np.zeros((4,6,3)),np.ones((4,6)))
+
+  def test_single_precision(self):
+    # single precision output should be close to double precision 
+    # output
+    np.random.seed(1)
+    x = np.random.random((5,2))
+    c = np.random.random((3,2))
+    for phi in [rbf.basis.ga,rbf.basis.phs2,rbf.basis.phs3]:
+      for diff in [(0,0),(1,0),(2,0)]:
+        out32 = phi(x,c,diff=diff,dtype=np.float32)
+        out64 = phi(x,c,diff=diff)
+        self.assertTrue(out32.dtype == np.float32)
+        self.assertTrue(np.allclose(out32,out64,rtol=1e-4,atol=1e-4))
+
 
 #unittest.main()
@@ -3,6 +3,7 @@ import numpy as np
 import rbf.fd
 import rbf.basis
 import rbf.halton
+import scipy.sparse
 import unittest
 
 def test_func2d(x):
@@ -180,3 +181,26 @@ class Test(unittest.TestCase):
     self.assertTrue(np.isclose(u.dot(w),diff_true,atol=1e-2))
     
                          
+
+  def test_weights_eps_shape(self):
+    # an *eps* array with the wrong length should raise an error
+    x = np.array([0.5,0.5])
+    s = rbf.halton.halton(10,2)
+    self.assertRaises(ValueError,rbf.fd.weights,x,s,[1,0],
+                      eps=np.ones(3))
+
+  def test_weight_matrix_procs(self):
+    # the weight matrix should not depend on the number of subprocesses
+    x = rbf.halton.halton(50,2)
+    L1 = rbf.fd.weight_matrix(x,x,[[2,0],[0,2]],n=10)
+    L2 = rbf.fd.weight_matrix(x,x,[[2,0],[0,2]],n=10,procs=2)
+    self.assertTrue(np.allclose(L1.toarray(),L2.toarray()))
+
+  def test_weight_matrix_coo(self):
+    # the COO weight matrix should have the same entries as the CSR 
+    # weight matrix
+    x = rbf.halton.halton(50,2)
+    L1 = rbf.fd.weight_matrix(x,x,[[2,0],[0,2]],n=10)
+    L2 = rbf.fd.weight_matrix(x,x,[[2,0],[0,2]],n=10,coo=True)
+    self.assertTrue(scipy.sparse.isspmatrix_coo(L2))
+    self.assertTrue(np.allclose(L1.toarray(),L2.toarray()))